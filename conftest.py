@@ -1,17 +1,43 @@
+import argparse
+import functools
+import heapq
 import json
 import os
-import posixpath
 import shutil
+import statistics
 import subprocess
 import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import click
 import pytest
 
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
 from mlflow.environment_variables import _MLFLOW_TESTING, MLFLOW_TRACKING_URI
 
 from tests.helper_functions import get_safe_port
 
+# This file lives in the root of the repo
+_REPO_ROOT = os.path.dirname(os.path.abspath(__file__))
+_IS_CI = os.getenv("CI", "false").lower() == "true"
+# Set `MLFLOW_TEST_SHOW_RESOURCES=1` to display memory and disk usage for each test result
+_SHOW_RESOURCES = os.environ.get("MLFLOW_TEST_SHOW_RESOURCES") == "1"
+
+
+def _positive_int(value):
+    try:
+        ivalue = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid int value: {value!r}") from None
+    if ivalue < 1:
+        raise argparse.ArgumentTypeError(f"must be >= 1, got {ivalue}")
+    return ivalue
+
 
 def pytest_addoption(parser):
     parser.addoption(
@@ -33,19 +59,22 @@ def pytest_addoption(parser):
     parser.addoption(
         "--splits",
         default=None,
-        type=int,
-        help="The number of groups to split tests into.",
+        type=_positive_int,
+        help=(
+            "The number of groups to split tests into. If `.test_durations` exists in the root "
+            "directory, tests are split based on the recorded durations."
+        ),
     )
     parser.addoption(
         "--group",
         default=None,
-        type=int,
+        type=_positive_int,
         help="The group of tests to run.",
     )
     parser.addoption(
         "--serve-wheel",
         action="store_true",
-        default=os.getenv("CI", "false").lower() == "true",
+        default=_IS_CI,
         help="Serve a wheel for the dev version of MLflow. True by default in CI, False otherwise.",
     )
 
@@ -56,28 +85,20 @@ def pytest_configure(config):
     config.addinivalue_line("markers", "notrackingurimock")
     config.addinivalue_line("markers", "allow_infer_pip_requirements_fallback")
 
+    # The verbose word is only displayed when verbosity >= 1 (`--quiet` cancels out `-v`)
+    if _SHOW_RESOURCES and psutil is not None and config.getoption("verbose") >= 1:
+        config.pluginmanager.register(_ResourceUsageReporter(), "resource_usage_reporter")
 
-@pytest.hookimpl(tryfirst=True)
-def pytest_cmdline_main(config):
     group = config.getoption("group")
     splits = config.getoption("splits")
-
-    if splits is None and group is None:
-        return None
-
-    if splits and group is None:
+    if splits is not None and group is None:
         raise pytest.UsageError("`--group` is required")
 
-    if group and splits is None:
+    if group is not None and splits is None:
         raise pytest.UsageError("`--splits` is required")
 
-    if splits < 0:
-        raise pytest.UsageError("`--splits` must be >= 1")
-
-    if group < 1 or group > splits:
-        raise pytest.UsageError("`--group` must be between 1 and {splits}")
-
-    return None
+    if group is not None and group > splits:
+        raise pytest.UsageError(f"`--group` must be between 1 and {splits}")
 
 
 def pytest_sessionstart(session):
@@ -93,102 +114,148 @@ def pytest_sessionstart(session):
         )
 
 
-def pytest_runtest_setup(item):
-    markers = [mark.name for mark in item.iter_markers()]
-    if "requires_ssh" in markers and not item.config.getoption("--requires-ssh"):
-        pytest.skip("use `--requires-ssh` to run this test")
+_GIB = 1 << 30
 
 
-@pytest.hookimpl(hookwrapper=True)
-def pytest_report_teststatus(report, config):
-    outcome = yield
-    if report.when == "call":
-        try:
-            import psutil
-        except ImportError:
-            return
+class _ResourceUsageReporter:
+    """
+    Appends memory and disk usage to the verbose test result (e.g. "PASSED | MEM ... | DISK ...").
+    """
+
+    def __init__(self):
+        self._last_sample_time = float("-inf")
+        self._last_suffix = None
+        # The disk size doesn't change during the session
+        self._disk_total = psutil.disk_usage("/").total / _GIB
 
-        (*rest, result) = outcome.get_result()
+    def _sample(self):
         mem = psutil.virtual_memory()
-        mem_used = mem.used / 1024**3
-        mem_total = mem.total / 1024**3
-
-        disk = psutil.disk_usage("/")
-        disk_used = disk.used / 1024**3
-        disk_total = disk.total / 1024**3
-        outcome.force_result(
-            (
-                *rest,
-                (
-                    f"{result} | "
-                    f"MEM {mem_used:.1f}/{mem_total:.1f} GB | "
-                    f"DISK {disk_used:.1f}/{disk_total:.1f} GB"
-                ),
-            )
+        mem_used = mem.used / _GIB
+        mem_total = mem.total / _GIB
+        disk_used = psutil.disk_usage("/").used / _GIB
+        return (
+            f"MEM {mem_used:.1f}/{mem_total:.1f} GB | "
+            f"DISK {disk_used:.1f}/{self._disk_total:.1f} GB"
         )
 
+    @pytest.hookimpl(hookwrapper=True)
+    def pytest_report_teststatus(self, report):
+        outcome = yield
+        if report.when == "call":
+            # Sampling memory and disk usage involves syscalls. Sample at most once per second
+            # and reuse the cached suffix in between.
+            now = time.monotonic()
+            if now - self._last_sample_time >= 1.0:
+                self._last_suffix = self._sample()
+                self._last_sample_time = now
+
+            (*rest, result) = outcome.get_result()
+            outcome.force_result((*rest, f"{result} | {self._last_suffix}"))
+
+
+# Ignored files and directories must be included in dev/run-python-flavor-tests.sh
+_MODEL_FLAVORS = frozenset(
+    {
+        # Tests of flavor modules.
+        "tests/azureml",
+        "tests/catboost",
+        "tests/diviner",
+        "tests/fastai",
+        "tests/gluon",
+        "tests/h2o",
+        "tests/johnsnowlabs",
+        "tests/keras",
+        "tests/keras_core",
+        "tests/langchain",
+        "tests/lightgbm",
+        "tests/mleap",
+        "tests/models",
+        "tests/onnx",
+        "tests/openai",
+        "tests/paddle",
+        "tests/pmdarima",
+        "tests/prophet",
+        "tests/pyfunc",
+        "tests/pytorch",
+        "tests/sagemaker",
+        "tests/sentence_transformers",
+        "tests/shap",
+        "tests/sklearn",
+        "tests/spacy",
+        "tests/spark",
+        "tests/statsmodels",
+        "tests/tensorflow",
+        "tests/transformers",
+        "tests/xgboost",
+        # Lazy loading test.
+        "tests/test_mlflow_lazily_imports_ml_packages.py",
+        # Tests of utils.
+        "tests/utils/test_model_utils.py",
+        # This test is included here because it imports many big libraries like tf, keras, etc.
+        "tests/tracking/fluent/test_fluent_autolog.py",
+        # Cross flavor autologging related tests.
+        "tests/autologging/test_autologging_safety_unit.py",
+        "tests/autologging/test_autologging_behaviors_unit.py",
+        "tests/autologging/test_autologging_behaviors_integration.py",
+        "tests/autologging/test_autologging_utils.py",
+        "tests/autologging/test_training_session.py",
+        # Opt in authentication feature.
+        "tests/server/auth",
+        "tests/gateway",
+    }
+)
+# Absolute paths with native separators to compare against collected paths as-is
+_MODEL_FLAVOR_PATHS = frozenset(
+    os.path.join(_REPO_ROOT, os.path.normpath(path)) for path in _MODEL_FLAVORS
+)
+# Recorded test durations used to balance `--splits` groups
+_TEST_DURATIONS_FILE = ".test_durations"
+
+
+def pytest_ignore_collect(collection_path, config):
+    if not config.getoption("ignore_flavors"):
+        return None
+
+    # pytest calls this hook for a directory before collecting its contents, so returning True
+    # for a flavor directory prunes the whole subtree.
+    if str(collection_path) in _MODEL_FLAVOR_PATHS:
+        return True
+
+    # Let other implementations (e.g. the default one) decide
+    return None
+
+
+def _load_test_durations(rootpath):
+    """
+    Loads previously recorded test durations (a JSON object mapping node IDs to seconds) from
+    `.test_durations` in the root directory. Returns an empty dict if the file doesn't exist
+    or can't be parsed.
+    """
+    try:
+        with open(os.path.join(rootpath, _TEST_DURATIONS_FILE)) as f:
+            durations = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return durations if isinstance(durations, dict) else {}
 
-@pytest.hookimpl(hookwrapper=True)
-def pytest_ignore_collect(path, config):
-    outcome = yield
-    if not outcome.get_result() and config.getoption("ignore_flavors"):
-        # If not ignored by the default hook and `--ignore-flavors` specified
-
-        # Ignored files and directories must be included in dev/run-python-flavor-tests.sh
-        model_flavors = [
-            # Tests of flavor modules.
-            "tests/azureml",
-            "tests/catboost",
-            "tests/diviner",
-            "tests/fastai",
-            "tests/gluon",
-            "tests/h2o",
-            "tests/johnsnowlabs",
-            "tests/keras",
-            "tests/keras_core",
-            "tests/langchain",
-            "tests/lightgbm",
-            "tests/mleap",
-            "tests/models",
-            "tests/onnx",
-            "tests/openai",
-            "tests/paddle",
-            "tests/pmdarima",
-            "tests/prophet",
-            "tests/pyfunc",
-            "tests/pytorch",
-            "tests/sagemaker",
-            "tests/sentence_transformers",
-            "tests/shap",
-            "tests/sklearn",
-            "tests/spacy",
-            "tests/spark",
-            "tests/statsmodels",
-            "tests/tensorflow",
-            "tests/transformers",
-            "tests/xgboost",
-            # Lazy loading test.
-            "tests/test_mlflow_lazily_imports_ml_packages.py",
-            # Tests of utils.
-            "tests/utils/test_model_utils.py",
-            # This test is included here because it imports many big libraries like tf, keras, etc.
-            "tests/tracking/fluent/test_fluent_autolog.py",
-            # Cross flavor autologging related tests.
-            "tests/autologging/test_autologging_safety_unit.py",
-            "tests/autologging/test_autologging_behaviors_unit.py",
-            "tests/autologging/test_autologging_behaviors_integration.py",
-            "tests/autologging/test_autologging_utils.py",
-            "tests/autologging/test_training_session.py",
-            # Opt in authentication feature.
-            "tests/server/auth",
-            "tests/gateway",
-        ]
-
-        relpath = os.path.relpath(str(path))
-        relpath = relpath.replace(os.sep, posixpath.sep)  # for Windows
-
-        if relpath in model_flavors:
-            outcome.force_result(True)
+
+def _split_by_durations(items, durations, splits, group):
+    """
+    Splits `items` into `splits` groups with balanced total durations using the longest
+    processing time first algorithm and returns the items in the `group`-th group. Tests without
+    a recorded duration are assumed to take the median of the recorded durations. The original
+    order of the items is preserved within each group.
+    """
+    default = statistics.median(durations.values())
+    item_durations = [durations.get(item.nodeid, default) for item in items]
+    # (total duration, group index)
+    heap = [(0.0, idx) for idx in range(splits)]
+    assigned = [None] * len(items)
+    for i in sorted(range(len(items)), key=item_durations.__getitem__, reverse=True):
+        total, idx = heapq.heappop(heap)
+        assigned[i] = idx
+        heapq.heappush(heap, (total + item_durations[i], idx))
+    return [item for item, idx in zip(items, assigned) if idx == group - 1]
 
 
 @pytest.hookimpl(trylast=True)
@@ -197,11 +264,26 @@ def pytest_collection_modifyitems(session, config, items):  # pylint: disable=un
     # results in an error because Flask >= 2.2.0 doesn't allow calling setup method such as
     # `before_request` on the application after the first request. To avoid this issue,
     # execute `tests.server.test_prometheus_exporter` first by reordering the test items.
-    items.sort(key=lambda item: item.module.__name__ != "tests.server.test_prometheus_exporter")
+    # A stable partition is enough here, there's no need to sort.
+    front, rest = [], []
+    for item in items:
+        is_front = item.module.__name__ == "tests.server.test_prometheus_exporter"
+        (front if is_front else rest).append(item)
+    if front:
+        items[:] = front + rest
+
+    if not config.getoption("--requires-ssh"):
+        skip_requires_ssh = pytest.mark.skip(reason="use `--requires-ssh` to run this test")
+        for item in items:
+            if item.get_closest_marker("requires_ssh"):
+                item.add_marker(skip_requires_ssh)
 
     # Select the tests to run based on the group and splits
     if (splits := config.getoption("--splits")) and (group := config.getoption("--group")):
-        items[:] = items[(group - 1) :: splits]
+        if durations := _load_test_durations(config.rootpath):
+            items[:] = _split_by_durations(items, durations, splits, group)
+        else:
+            items[:] = items[(group - 1) :: splits]
 
 
 @pytest.hookimpl(hookwrapper=True)
@@ -213,13 +295,59 @@ def pytest_terminal_summary(
     if failed_test_reports:
         if len(failed_test_reports) <= 30:
             terminalreporter.section("command to run failed test cases")
-            ids = [repr(report.nodeid) for report in failed_test_reports]
+            ids = (repr(report.nodeid) for report in failed_test_reports)
         else:
             terminalreporter.section("command to run failed test suites")
-            # Use dict.fromkeys to preserve the order
-            ids = list(dict.fromkeys(report.fspath for report in failed_test_reports))
-        terminalreporter.write(" ".join(["pytest"] + ids))
-        terminalreporter.write("\n" * 2)
+            # Use dict.fromkeys to dedupe while preserving the order
+            ids = dict.fromkeys(report.fspath for report in failed_test_reports)
+        terminalreporter.write("pytest " + " ".join(ids) + "\n\n")
+
+
+@functools.lru_cache(maxsize=1)
+def _get_conda_info():
+    # `conda info` is slow and its output used here doesn't change during the session
+    return json.loads(subprocess.check_output(["conda", "info", "--json"], text=True))
+
+
+def _list_conda_envs():
+    """
+    Lists conda environments other than the base environment by scanning the environment
+    directories, which picks up environments created after `conda info` was cached.
+    """
+    conda_info = _get_conda_info()
+    root_prefix = conda_info["root_prefix"]
+    envs = []
+    for envs_dir in conda_info["envs_dirs"]:
+        if not os.path.isdir(envs_dir):
+            continue
+        with os.scandir(envs_dir) as entries:
+            envs.extend(
+                entry.path
+                for entry in entries
+                if entry.is_dir()
+                and entry.path != root_prefix
+                and os.path.isdir(os.path.join(entry.path, "conda-meta"))
+            )
+    return envs
+
+
+def _remove_dir(path):
+    if os.name == "nt":
+        shutil.rmtree(path, ignore_errors=True)
+    else:
+        # `rm -rf` walks the directory tree much faster than `shutil.rmtree`
+        subprocess.run(["rm", "-rf", path], check=False)
+
+
+def _remove_dirs(paths):
+    """
+    Removes directories in parallel. Environment directories contain tens of thousands of small
+    files and removing them is I/O-bound.
+    """
+    if not paths:
+        return
+    with ThreadPoolExecutor(max_workers=min(len(paths), os.cpu_count() or 1)) as executor:
+        list(executor.map(_remove_dir, paths))
 
 
 @pytest.fixture(scope="module", autouse=True)
@@ -229,13 +357,12 @@ def clean_up_envs():
     if "GITHUB_ACTIONS" in os.environ:
         from mlflow.utils.virtualenv import _get_mlflow_virtualenv_root
 
-        shutil.rmtree(_get_mlflow_virtualenv_root(), ignore_errors=True)
+        dirs = []
+        if os.path.exists(virtualenv_root := _get_mlflow_virtualenv_root()):
+            dirs.append(virtualenv_root)
         if os.name != "nt":
-            conda_info = json.loads(subprocess.check_output(["conda", "info", "--json"], text=True))
-            root_prefix = conda_info["root_prefix"]
-            for env in conda_info["envs"]:
-                if env != root_prefix:
-                    shutil.rmtree(env, ignore_errors=True)
+            dirs.extend(_list_conda_envs())
+        _remove_dirs(dirs)
 
 
 @pytest.fixture(scope="session", autouse=True)
@@ -262,21 +389,8 @@ def serve_wheel(request, tmp_path_factory):
     mlflow_dir = root.joinpath("mlflow")
     mlflow_dir.mkdir()
     port = get_safe_port()
-    try:
-        repo_root = subprocess.check_output(
-            [
-                "git",
-                "rev-parse",
-                "--show-toplevel",
-            ],
-            text=True,
-        ).strip()
-    except subprocess.CalledProcessError:
-        # Some tests run in a Docker container where git is not installed.
-        # In this case, assume we're in the root of the repo.
-        repo_root = "."
-
-    subprocess.run(
+    # Build the wheel in the background while the server below starts up
+    build_prc = subprocess.Popen(
         [
             sys.executable,
             "-m",
@@ -285,9 +399,10 @@ def serve_wheel(request, tmp_path_factory):
             "--wheel-dir",
             mlflow_dir,
             "--no-deps",
-            repo_root,
+            _REPO_ROOT,
         ],
-        check=True,
+        # Skip the PyPI request to check for a newer pip version
+        env={**os.environ, "PIP_DISABLE_PIP_VERSION_CHECK": "1"},
     )
     with subprocess.Popen(
         [
@@ -298,10 +413,24 @@ def serve_wheel(request, tmp_path_factory):
         ],
         cwd=root,
     ) as prc:
-        url = f"http://localhost:{port}"
-        if existing_url := os.environ.get("PIP_EXTRA_INDEX_URL"):
-            url = f"{existing_url} {url}"
-        os.environ["PIP_EXTRA_INDEX_URL"] = url
+        try:
+            if build_prc.wait() != 0:
+                raise subprocess.CalledProcessError(build_prc.returncode, build_prc.args)
 
-        yield
-        prc.terminate()
+            # `http.server` serves `index.html` for a directory request instead of generating a
+            # listing, so pre-render a PEP 503 simple index page for the project.
+            links = "".join(
+                f'<a href="{whl.name}">{whl.name}</a>\n' for whl in mlflow_dir.glob("*.whl")
+            )
+            mlflow_dir.joinpath("index.html").write_text(
+                f"<!DOCTYPE html>\n<html><body>\n{links}</body></html>\n"
+            )
+
+            url = f"http://localhost:{port}"
+            if existing_url := os.environ.get("PIP_EXTRA_INDEX_URL"):
+                url = f"{existing_url} {url}"
+            os.environ["PIP_EXTRA_INDEX_URL"] = url
+
+            yield
+        finally:
+            prc.terminate()